@@ -5,15 +5,33 @@
 # This module reads an ASC file that contains the PfPR for the two to ten age
 # bracket and generates three ASC files with beta values.
 import argparse
+import math
 import os
 import sys
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# Numba is optional, without it the kernel runs as plain Python and the rows 
+# are divided between processes instead
+try:
+    from numba import njit, prange
+    JIT = True
+except ImportError:
+    JIT = False
+    prange = range
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
 # Import our libraries
 sys.path.append(os.path.join(os.path.dirname(__file__), "include"))
 
 import include.calibrationLib as cl
 import include.standards as std
-from include.ascFile import load_asc, write_asc
+from include.ascFile import load_asc, write_asc, write_asc_binary
 from include.utility import progressBar
 
 
@@ -24,10 +42,41 @@ BETAVALUES = "data/calibration.csv"
 EPSILON = 0.00001
 MAX_EPSILON = 0.1
 
-# Warnings to be passed between functions
-WARNINGS = ''
+# Format for the values in the maps, the betas do not need more than five
+# significant digits for the simulation
+MAP_FORMAT = '%.5g'
+
+# Lower bound of each bucket in the epsilon distribution
+THRESHOLDS = np.array([1e-1, 1e-2, 1e-3, 1e-4, 1e-5])
+
+# Number of unique cells to process between progress updates
+PROGRESS_CELLS = 10000
+
+# Size of the tiles, in cells per side, to use when resolving the bins
+TILE = 256
+
+# Status codes returned by the kernel for each cell
+STATUS_NODATA = -1
+STATUS_OK = 0
+STATUS_MISSING = 1
+STATUS_NO_ZONE = 2
+
+# Warnings to be passed between functions, the bins that have been warned about
+# are tracked separately so the messages stay in the order they were raised
+_warned = set()
+_warning_msgs = []
 
-def create_beta_map(configuration, gisPath, prefix, age, pfpr_file):
+# Calibration bins for the worker processes, set when the worker starts
+_BINS = None
+
+
+# Create the epsilon and beta maps for the PfPR raster. If quantize is set then the
+# PfPR values are rounded to the nearest step of EPSILON before the betas are 
+# determined so cells with nearly the same PfPR share work, note that this shifts
+# the center of the search and changes the epsilons and betas in the maps. The
+# maps are computed as float64 but saved as float32, if binary is set then NumPy
+# (.npy) copies of the maps are saved alongside the ASC files.
+def create_beta_map(configuration, gisPath, prefix, age, pfpr_file, binary=False, quantize=False):
    
     # Load the relevant raster files
     filename = os.path.join(gisPath, std.PFPR_FILE.format(prefix))
@@ -46,6 +95,7 @@ def create_beta_map(configuration, gisPath, prefix, age, pfpr_file):
     # Make sure the data loaded correct, or that there is data
     if len(lookup) == 0:
         raise ValueError("No calibration data is present in the file: {}".format(BETAVALUES))
+    bins = load_bins(lookup)
 
     # Verify that the age band matches what the file returns, errors are only likely to occur when
     # the user tries to use cached data
@@ -59,70 +109,76 @@ def create_beta_map(configuration, gisPath, prefix, age, pfpr_file):
     if error is not None:
         raise Exception('Mismatch between parameters and calibration file, expected {}'.format(error))
 
-    # Prepare for the ASC data
-    epsilons = []
+    # Prepare for the ASC data as contiguous arrays, note that float64 is used since
+    # the treatments are matched exactly against the calibrated values
+    nodata = ascHeader['nodata']
+    pfpr = np.ascontiguousarray(pfpr, dtype=float)
+    population = np.ascontiguousarray(population, dtype=float)
+    climate = np.ascontiguousarray(climate, dtype=float)
+    treatments = np.ascontiguousarray(treatments, dtype=float)
     maxEpsilon = 0
-    meanBeta = []
+    maxValues = ''
 
-    # Prepare to track the distribution
-    distribution = [0] * 5
+    # Quantize the PfPR if requested, the original values are kept for the zero PfPR
+    # check and for reporting so the cells can be found in the input
+    search = pfpr
+    if quantize:
+        search = np.where(pfpr != nodata, np.round(pfpr / EPSILON) * EPSILON, pfpr)
 
-    # Scan each of the rows 
+    # Get the beta values for each of the cells
     print("\nDetermining betas for {}\nRaster Size: {} rows, {} columns".format(ageBand, ascHeader['nrows'], ascHeader['ncols']))
-    for row in range(0, ascHeader['nrows']):
-
-        # Append the empty rows
-        epsilons.append([])
-        meanBeta.append([])
-
-        # Scan each of the PfPR values    
-        for col in range(0, ascHeader['ncols']):
-
-            # Append nodata and continue
-            if pfpr[row][col] == ascHeader['nodata']:
-                epsilons[row].append(ascHeader['nodata'])
-                meanBeta[row].append(ascHeader['nodata'])
-                continue
-
-            # Get the beta values
-            [values, epsilon] = get_betas(climate[row][col], pfpr[row][col], population[row][col], treatments[row][col], lookup)
-
-            # Update the distribution
-            for exponent in range(1, len(distribution) + 1):
-                if epsilon >= pow(10, -exponent):
-                    distribution[exponent - 1] += 1
-                    break
-
-            # Was nothing returned?
-            if len(values) == 0:
-                epsilons[row].append(0)
-                meanBeta[row].append(0)
-                continue
-
-            # Note the epsilon and the mean
-            epsilons[row].append(epsilon)
-            if epsilon > maxEpsilon: 
-                maxEpsilon = epsilon
-
-                # Determine the population and treatment bin we are working with
-                zone = climate[row][col]
-                maxValues = "PfPR: {}, Population: {} (Bin: {}), Treatment: {}".format(
-                    pfpr[row][col], population[row][col], cl.get_bin(population[row][col], lookup[zone].keys()), treatments[row][col])
-            meanBeta[row].append(sum(values) / len(values))
-
-        # Note the progress
-        progressBar(row + 1, ascHeader['nrows'])
+    if JIT:
+        results = _process_rows(search, population, treatments, climate, nodata, bins, True)
+    else:
+        results = _process_rows_parallel(search, population, treatments, climate, nodata, bins)
+    [zoneIndex, populationIndex, treatmentIndex, status, epsilons, meanBeta, unique] = results
+
+    # Make sure the zones were all present
+    missing = np.argwhere(status == STATUS_NO_ZONE)
+    if len(missing) > 0:
+        row, col = missing[0]
+        raise ValueError("Zone {} was not found in lookup".format(climate[row, col]))
+    valid = status != STATUS_NODATA
+    print("Unique Cells: {} of {}".format(unique, np.count_nonzero(valid)))
+
+    # If the PfPR is zero then verify that beta returned will be zero, noting the bins
+    # in the order they are first found in the raster
+    zeroed = valid & (pfpr == 0) & (meanBeta > 0)
+    epsilons[zeroed] = 0
+    meanBeta[zeroed] = 0
+    keys, first = np.unique(np.column_stack((zoneIndex[zeroed], populationIndex[zeroed], treatmentIndex[zeroed])),
+                            axis=0, return_index=True)
+    for key in keys[np.argsort(first)]:
+        add_warning(bins, *key)
+
+    # Note the matches that were not found
+    for row, col in np.argwhere(status == STATUS_MISSING):
+        print('Match not found!\nPfPR: ', pfpr[row, col], 'Population: ', population[row, col])
+
+    # Note the maximum epsilon and the population and treatment bin it was in
+    values = np.where(valid, epsilons, 0)
+    if values.max(initial=0) > 0:
+        row, col = np.unravel_index(values.argmax(), values.shape)
+        maxEpsilon = epsilons[row, col]
+        [populationBin, _] = get_bins(climate[row, col], population[row, col], treatments[row, col], bins)
+        maxValues = "PfPR: {}, Population: {} (Bin: {}), Treatment: {}".format(
+            pfpr[row, col], population[row, col], populationBin, treatments[row, col])
+
+    # Bin the epsilons by the largest threshold they meet to get the distribution, 
+    # epsilons below the smallest threshold (i.e., zero) are not counted
+    positions = np.searchsorted(THRESHOLDS[::-1], epsilons[valid], side='right')
+    distribution = np.bincount(len(THRESHOLDS) - positions[positions > 0], minlength=len(THRESHOLDS))
 
     # Print the warnings, if any
-    if len(WARNINGS) > 0:
-        print(WARNINGS)
+    if len(_warning_msgs) > 0:
+        print('\n' + '\n'.join(_warning_msgs))
 
     # Write the results
     print("\n Max epsilon: {:.6f} / {}".format(maxEpsilon, maxValues))
     print("Epsilon Distribution")
     total = 0
     for ndx in range(0, len(distribution)):
-        print("{:>6} : {}".format(pow(10, -(ndx + 1)), distribution[ndx]))
+        print("{:>6} : {}".format(THRESHOLDS[ndx], distribution[ndx]))
         total += distribution[ndx]
     print("Total Cells: {}".format(total))
     
@@ -130,85 +186,308 @@ def create_beta_map(configuration, gisPath, prefix, age, pfpr_file):
     if not os.path.isdir('out'): os.mkdir('out')
 
     # Save the maps        
-    filename = "out/{}_epsilons.asc".format(prefix)
-    print("\nSaving {}".format(filename))
-    write_asc(ascHeader, epsilons, filename)
-    filename = "out/{}_beta.asc".format(prefix)
-    print("Saving {}".format(filename))
-    write_asc(ascHeader, meanBeta, filename)
-
-
-# Get the beta values that generate the PfPR for the given population and 
-# treatment level, this function will start with the lowest epsilon value 
-# and increase it until at least one value is found to be returned
-def get_betas(zone, pfpr, population, treatment, lookup):
-    global WARNINGS
-
-    # Initial values
-    epsilon = 0
-    betas = []
-
-    # Increase the epsilon until at least one value is found
-    while len(betas) == 0:
-        epsilon += EPSILON
-        betas = get_betas_scan(zone, pfpr, population, treatment, lookup, epsilon)
-
-        # Prevent an infinite loop, will result in an error
-        if epsilon == MAX_EPSILON:
-            print('Match not found!\nPfPR: ', pfpr, 'Population: ', population)
-            return [None, None]
-
-    # If the PfPR is zero then verify that beta returned will be zero
-    if pfpr == 0 and sum(betas) > 0:
-        # Resolve the bins
-        populationBin = int(cl.get_bin(population, lookup[zone].keys()))
-        treatmentBin = cl.get_bin(treatment, lookup[zone][populationBin].keys())
-
-        # Append a warning for this bin if it hasn't already been added
-        binning = "Zone: {}, Population: {}, Treatment: {}".format(zone, populationBin, treatmentBin)
-        if binning not in WARNINGS:
-            WARNINGS += '\nWARNING: Non-zero beta returned when PfPR is zero for bin = {}'.format(binning)
-        return [[0], 0]
-
-    # Return the results
-    return [betas, epsilon] 
-
-
-# Get the beta values that generate the PfPR for the given population and 
-# treatment level, within the given margin of error.
-def get_betas_scan(zone, pfpr, population, treatment, lookup, epsilon):
-
-    # The zone is a bin, so it should just be there
-    if not zone in lookup:
+    print()
+    for name, values in (('epsilons', epsilons), ('beta', meanBeta)):
+        filename = "out/{}_{}.asc".format(prefix, name)
+        print("Saving {}".format(filename))
+        write_asc(ascHeader, values.astype(np.float32), filename, fmt=MAP_FORMAT)
+        if binary:
+            filename = "out/{}_{}.npy".format(prefix, name)
+            print("Saving {}".format(filename))
+            write_asc_binary(values, filename)
+
+
+# Resolve the bins and get the beta values for the rows supplied. Many cells share
+# the same bins and PfPR, so only the unique combinations are scanned with the 
+# results scattered back to the cells. Returns the zone, population, and treatment
+# bin indices, the status, epsilons, and mean betas for the rows along with the
+# number of unique combinations.
+def _process_rows(pfpr, population, treatments, climate, nodata, bins, progress):
+
+    # Resolve the bins for each of the cells
+    zoneIndex = np.empty(pfpr.shape, dtype=np.int64)
+    populationIndex = np.empty(pfpr.shape, dtype=np.int64)
+    treatmentIndex = np.empty(pfpr.shape, dtype=np.int64)
+    status = np.empty(pfpr.shape, dtype=np.int8)
+    resolve = _resolve if JIT else _digitize_bins
+    resolve(pfpr, population, treatments, climate, nodata, 
+            bins['zones'], bins['populations'], bins['populationCounts'], bins['treatments'], bins['treatmentCounts'],
+            zoneIndex, populationIndex, treatmentIndex, status)
+    valid = status == STATUS_OK
+
+    # Get the beta values for the unique combinations
+    keys = np.column_stack((zoneIndex[valid], populationIndex[valid], treatmentIndex[valid], pfpr[valid]))
+    keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    uniqueZones = np.ascontiguousarray(keys[:, 0], dtype=np.int64)
+    uniquePopulations = np.ascontiguousarray(keys[:, 1], dtype=np.int64)
+    uniqueTreatments = np.ascontiguousarray(keys[:, 2], dtype=np.int64)
+    uniquePfpr = np.ascontiguousarray(keys[:, 3])
+    uniqueEpsilons = np.empty(len(keys), dtype=float)
+    uniqueBetas = np.empty(len(keys), dtype=float)
+    uniqueStatus = np.empty(len(keys), dtype=np.int8)
+    for start in range(0, len(keys), PROGRESS_CELLS):
+        cells = slice(start, start + PROGRESS_CELLS)
+        _fill(uniquePfpr[cells], uniqueZones[cells], uniquePopulations[cells], uniqueTreatments[cells], 
+              bins['pfpr'], bins['beta'], bins['offsets'], bins['lengths'], 
+              uniqueEpsilons[cells], uniqueBetas[cells], uniqueStatus[cells])
+        if progress: progressBar(min(start + PROGRESS_CELLS, len(keys)), len(keys))
+
+    # Cells without data retain the nodata value
+    epsilons = np.full(pfpr.shape, nodata, dtype=float)
+    meanBeta = np.full(pfpr.shape, nodata, dtype=float)
+    epsilons[valid] = uniqueEpsilons[inverse]
+    meanBeta[valid] = uniqueBetas[inverse]
+    status[valid] = uniqueStatus[inverse]
+    return [zoneIndex, populationIndex, treatmentIndex, status, epsilons, meanBeta, len(keys)]
+
+
+# Divide the rows between worker processes and process them in blocks, returning
+# the same results as _process_rows with the unique combinations counted per block.
+def _process_rows_parallel(pfpr, population, treatments, climate, nodata, bins):
+    workers = os.cpu_count() or 1
+    size = max(1, len(pfpr) // (4 * workers))
+
+    # Prepare for the results
+    results = [np.empty(pfpr.shape, dtype=np.int64) for _ in range(3)]
+    results.append(np.empty(pfpr.shape, dtype=np.int8))
+    results.extend(np.empty(pfpr.shape, dtype=float) for _ in range(2))
+    unique = 0
+
+    # The bins are passed once to each worker, only the rows are sent with the blocks
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(bins,)) as executor:
+        futures = {}
+        for row in range(0, len(pfpr), size):
+            rows = slice(row, row + size)
+            future = executor.submit(_process_row_block, pfpr[rows], population[rows], treatments[rows], climate[rows],
+                                     nodata)
+            futures[future] = rows
+
+        # Copy the blocks into the results as they complete
+        for count, future in enumerate(as_completed(futures), 1):
+            block = future.result()
+            for result, values in zip(results, block):
+                result[futures[future]] = values
+            unique += block[-1]
+            progressBar(count, len(futures))
+
+    return results + [unique]
+
+
+# Note the calibration bins for the worker process
+def _init_worker(bins):
+    global _BINS
+    _BINS = bins
+
+
+# Process the block of rows, called by the worker processes
+def _process_row_block(pfpr, population, treatments, climate, nodata):
+    return _process_rows(pfpr, population, treatments, climate, nodata, _BINS, False)
+
+
+# Note that a non-zero beta was returned when the PfPR is zero for the bin
+def add_warning(bins, zoneIndex, populationIndex, treatmentIndex):
+
+    # Append a warning for this bin if it hasn't already been added
+    binning = (bins['zones'][zoneIndex], int(bins['populations'][zoneIndex, populationIndex]), 
+        bins['treatments'][zoneIndex, populationIndex, treatmentIndex])
+    if binning not in _warned:
+        _warned.add(binning)
+        _warning_msgs.append('WARNING: Non-zero beta returned when PfPR is zero for bin = '
+                             'Zone: {}, Population: {}, Treatment: {}'.format(*binning))
+
+
+# Get the population and treatment bin for the given values
+def get_bins(zone, population, treatment, bins):
+    [zoneIndex, populationIndex, treatmentIndex] = _get_bins(zone, population, treatment, 
+        bins['zones'], bins['populations'], bins['populationCounts'], bins['treatments'], bins['treatmentCounts'])
+    if zoneIndex == -1:
         raise ValueError("Zone {} was not found in lookup".format(zone))
+    return [int(bins['populations'][zoneIndex, populationIndex]),
+            bins['treatments'][zoneIndex, populationIndex, treatmentIndex]]
+
+
+# Prepare the calibration lookup for scanning by flattening the bins into sorted
+# arrays. The population and treatment bins are padded to a common length, with
+# populations[zone, :populationCounts[zone]] and treatments[zone, population,
+# :treatmentCounts[zone, population]] holding the bins. The PfPR and beta values
+# for each bin are stored contiguously with the bin's values found in 
+# pfpr[offset:offset + length] where the offset and length are indexed by
+# [zone, population, treatment].
+def load_bins(lookup):
+
+    # Sort the keys for each of the bins
+    zones = sorted(lookup)
+    populations = [sorted(lookup[zone]) for zone in zones]
+    treatments = [[sorted(lookup[zone][population]) for population in keys] for zone, keys in zip(zones, populations)]
+
+    # Pad the bins and flatten the PfPR and beta values
+    shape = (len(zones), max(len(keys) for keys in populations), max(len(keys) for row in treatments for keys in row))
+    populationKeys = np.zeros(shape[:2], dtype=float)
+    populationCounts = np.zeros(shape[0], dtype=np.int64)
+    treatmentKeys = np.zeros(shape, dtype=float)
+    treatmentCounts = np.zeros(shape[:2], dtype=np.int64)
+    offsets = np.zeros(shape, dtype=np.int64)
+    lengths = np.zeros(shape, dtype=np.int64)
+    pfprs, betas = [], []
+    for zoneIndex, zone in enumerate(zones):
+        populationKeys[zoneIndex, :len(populations[zoneIndex])] = populations[zoneIndex]
+        populationCounts[zoneIndex] = len(populations[zoneIndex])
+        for populationIndex, population in enumerate(populations[zoneIndex]):
+            keys = treatments[zoneIndex][populationIndex]
+            treatmentKeys[zoneIndex, populationIndex, :len(keys)] = keys
+            treatmentCounts[zoneIndex, populationIndex] = len(keys)
+            for treatmentIndex, treatment in enumerate(keys):
+                values = sorted(lookup[zone][population][treatment], key=lambda value: value[0])
+                offsets[zoneIndex, populationIndex, treatmentIndex] = len(pfprs)
+                lengths[zoneIndex, populationIndex, treatmentIndex] = len(values)
+                pfprs.extend(value[0] for value in values)
+                betas.extend(value[1] for value in values)
+
+    return {
+        'zones': np.array(zones, dtype=float),
+        'populations': populationKeys,
+        'populationCounts': populationCounts,
+        'treatments': treatmentKeys,
+        'treatmentCounts': treatmentCounts,
+        'pfpr': np.array(pfprs, dtype=float),
+        'beta': np.array(betas, dtype=float),
+        'offsets': offsets,
+        'lengths': lengths
+    }
+
+
+# Find the first index between low and high (exclusive) of the sorted values
+# where the value could be inserted, after any equal values if right is set.
+@njit
+def _bisect(values, value, low, high, right):
+    while low < high:
+        middle = (low + high) // 2
+        if values[middle] < value or (right and values[middle] == value):
+            low = middle + 1
+        else:
+            high = middle
+    return low
 
-    # Determine the population and treatment bin we are working with
-    populationBin = cl.get_bin(population, lookup[zone].keys())
-    treatmentBin = cl.get_bin(treatment, lookup[zone][populationBin].keys())
-    
-    # Note the bounds
-    low = pfpr - epsilon
-    high = pfpr + epsilon
-
-    # Scan the PfPR values for the population and treatment level that are 
-    # within the margin
-    betas = []
-    for value in lookup[zone][populationBin][treatmentBin]:
-
-        # Add the value if it is in the bounds
-        if low <= value[0] and value[0] <= high:
-            betas.append(value[1])
-            
-        # We assume the data is stored, so break once the high value is less
-        # than the current PfPR
-        if high < value[0]: break
-
-    # Return the betas collected
-    return(betas)
+
+# Get the index of the zone, population, and treatment bin for the given values,
+# with the zone index being -1 if the zone is not in the bins. Values fall in the
+# first bin that is greater than or equal to them, or the last bin if they are 
+# larger than all of them.
+@njit
+def _get_bins(zone, population, treatment, zones, populations, populationCounts, treatments, treatmentCounts):
+    # The zone is a bin, so it should just be there
+    zoneIndex = _bisect(zones, zone, 0, zones.size, False)
+    if zoneIndex == zones.size or zones[zoneIndex] != zone:
+        return -1, 0, 0
+
+    count = populationCounts[zoneIndex]
+    populationIndex = min(_bisect(populations[zoneIndex], population, 0, count, False), count - 1)
+    count = treatmentCounts[zoneIndex, populationIndex]
+    treatmentIndex = min(_bisect(treatments[zoneIndex, populationIndex], treatment, 0, count, False), count - 1)
+    return zoneIndex, populationIndex, treatmentIndex
+
+
+# Resolve the index of the zone, population, and treatment bin for each cell,
+# along with a status code that notes the cells that have no PfPR or zone. The 
+# raster is processed in square tiles so the rows of all seven arrays that are
+# being worked on stay in cache, with the tiles divided between the threads.
+@njit(parallel=True)
+def _resolve(pfpr, population, treatment, climate, nodata, zones, populations, populationCounts, treatments,
+             treatmentCounts, zoneIndex, populationIndex, treatmentIndex, status):
+    rows, cols = pfpr.shape
+    tileCols = (cols + TILE - 1) // TILE
+    tiles = ((rows + TILE - 1) // TILE) * tileCols
+    for tile in prange(tiles):
+        rowStart = (tile // tileCols) * TILE
+        colStart = (tile % tileCols) * TILE
+        for row in range(rowStart, min(rowStart + TILE, rows)):
+            for col in range(colStart, min(colStart + TILE, cols)):
+
+                # Press on if there is nothing to do
+                if pfpr[row, col] == nodata:
+                    status[row, col] = STATUS_NODATA
+                    continue
+
+                # Resolve the bins for the cell
+                zoneIndex[row, col], populationIndex[row, col], treatmentIndex[row, col] = _get_bins(
+                    climate[row, col], population[row, col], treatment[row, col], 
+                    zones, populations, populationCounts, treatments, treatmentCounts)
+                status[row, col] = STATUS_OK if zoneIndex[row, col] != -1 else STATUS_NO_ZONE
+
+
+# Resolve the bins for each cell in the same manner as _resolve, but with one 
+# vectorized pass per zone and population bin. This is used in place of the 
+# kernel when Numba is not available since the kernel would run as plain Python.
+def _digitize_bins(pfpr, population, treatment, climate, nodata, zones, populations, populationCounts, treatments,
+                   treatmentCounts, zoneIndex, populationIndex, treatmentIndex, status):
+    status[:] = STATUS_NO_ZONE
+    status[pfpr == nodata] = STATUS_NODATA
+    for zone in range(len(zones)):
+        cells = (climate == zones[zone]) & (pfpr != nodata)
+        zoneIndex[cells] = zone
+        status[cells] = STATUS_OK
+
+        # Values fall in the first bin that is greater than or equal to them, or 
+        # the last bin if they are larger than all of them
+        count = populationCounts[zone]
+        index = np.digitize(population[cells], populations[zone, :count], right=True)
+        populationIndex[cells] = np.minimum(index, count - 1)
+        for ndx in range(count):
+            match = cells & (populationIndex == ndx)
+            treatmentCount = treatmentCounts[zone, ndx]
+            index = np.digitize(treatment[match], treatments[zone, ndx, :treatmentCount], right=True)
+            treatmentIndex[match] = np.minimum(index, treatmentCount - 1)
+
+
+# Get the mean of the beta values that generate the PfPR for each cell with the
+# lowest epsilon value that returns at least one value, which is the distance to
+# the nearest PfPR rounded up to the next step of EPSILON. The epsilon, mean beta,
+# and a status code are written for each cell.
+@njit(parallel=True, fastmath=True)
+def _fill(pfpr, zoneIndex, populationIndex, treatmentIndex, pfprs, betas, offsets, lengths, epsilons, meanBeta, status):
+    for ndx in prange(pfpr.size):
+        value = pfpr[ndx]
+        start = offsets[zoneIndex[ndx], populationIndex[ndx], treatmentIndex[ndx]]
+        end = start + lengths[zoneIndex[ndx], populationIndex[ndx], treatmentIndex[ndx]]
+
+        # Find the distance to the nearest PfPR on either side of the value
+        distance = MAX_EPSILON + 1
+        nearest = _bisect(pfprs, value, start, end, False)
+        if nearest > start:
+            distance = value - pfprs[nearest - 1]
+        if nearest < end:
+            distance = min(distance, pfprs[nearest] - value)
+
+        # Prevent a match beyond the maximum epsilon
+        if distance > MAX_EPSILON:
+            epsilons[ndx] = 0
+            meanBeta[ndx] = 0
+            status[ndx] = STATUS_MISSING
+            continue
+
+        # Quantize the distance to the epsilon step, allowing for rounding error in the
+        # division so exact multiples are not pushed up a step, and widen the margin if
+        # that rounding leaves the nearest value just outside of the bounds
+        steps = max(math.ceil(distance / EPSILON - 1e-6), 1)
+        while True:
+            epsilon = steps * EPSILON
+            low = _bisect(pfprs, value - epsilon, start, end, False)
+            high = _bisect(pfprs, value + epsilon, start, end, True)
+            if high > low: break
+            steps += 1
+
+        # Note the results
+        total = 0.0
+        for beta in range(low, high):
+            total += betas[beta]
+        epsilons[ndx] = epsilon
+        meanBeta[ndx] = total / (high - low)
+        status[ndx] = STATUS_OK
     
 
 # Main entry point for the script
-def main(configuration, gisPath, studyId, useCache, age, pfpr):
+def main(configuration, gisPath, studyId, useCache, age, pfpr, binary, quantize):
 
     # Parse the country prefix
     prefix = cl.get_prefix(configuration)
@@ -229,7 +508,7 @@ def main(configuration, gisPath, studyId, useCache, age, pfpr):
         sys.stderr.write("ERROR: {}\n".format(str(err)))
 
     # Proceed with creating beta map
-    create_beta_map(cfg, gisPath, prefix, age, pfpr)
+    create_beta_map(cfg, gisPath, prefix, age, pfpr, binary, quantize)
 
 
 if __name__ == "__main__":
@@ -241,6 +520,9 @@ if __name__ == "__main__":
     parser.add_argument('--age', action='store', dest='age', default='2-10', help='The age band to use for map generation, either 0-59 or 2-10 (default)')
     parser.add_argument('--pfpr', action='store', dest='pfpr', default=None, help='Override the default PfPR file with the one supplied')
     parser.add_argument('--cache', action='store_true', dest='useCache', help='Use cached values for the calibration')
+    parser.add_argument('--binary', action='store_true', dest='binary', help='Also save the maps as NumPy (.npy) files')
+    parser.add_argument('--quantize', action='store_true', dest='quantize',
+                        help='Round the PfPR to the nearest step of epsilon before matching, this changes the results')
     args = parser.parse_args()
 
     # Check to make sure the age band supplied is valid
@@ -255,7 +537,8 @@ if __name__ == "__main__":
     
     # Call the main function with the parameters
     try:
-        main(args.configuration, args.gis, int(args.studyid), args.useCache, args.age, args.pfpr)
+        main(args.configuration, args.gis, int(args.studyid), args.useCache, args.age, args.pfpr, args.binary,
+             args.quantize)
     except Exception as err:
         sys.stderr.write("ERROR: {}\n".format(str(err)))
         sys.exit(1)
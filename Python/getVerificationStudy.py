@@ -9,6 +9,7 @@
 # Note that results for the model burn-in period are include and may contain
 # invalid data.
 import argparse
+import csv
 import os
 import sys
 
@@ -19,6 +20,9 @@ import include.calibrationLib as cl
 from include.database import select, DatabaseError
  
 
+# Buffer size to use when writing the data set to disk
+CSV_BUFFER = 1 << 20
+
 SELECT_REPLICATES = """
 SELECT r.id, c.filename, 
     to_char(r.starttime, 'YYYY-MON-DD HH24:MI:SS'), 
@@ -98,25 +102,24 @@ def main(configuration, studyId):
             print("{} is not in the list of replicates".format(replicateId))
             exit(0)
 
-        # Load the data set, exit if nothing is returned
+        # Load the data set, streaming the rows to disk, exit if nothing is returned
         query = SELECT_DATASET_DISTRICT
         if replicates[ids.index(replicateId)][4] == 'C':
             query = SELECT_DATASET_CELLULAR
-        rows, columns = select(cfg["connection_string"], query, {'replicateId':replicateId}, True)
-        if len(rows) == 0:
+        rows, columns = select(cfg["connection_string"], query, {'replicateId':replicateId}, True, stream=True)
+        first = next(rows, None)
+        if first is None:
             print("No data returned!")
             exit(0)
     
         # Save the replicate to disk
         filename = "{}-{}-verification-data.csv".format(prefix, replicateId)
         print("Saving data set to: {}".format(filename))
-        with open(filename, "w") as csvfile:
-            csvfile.write("")
-            line = ','.join(str(columns[ndx]) for ndx in range(0, len(columns)))
-            csvfile.write("{}\n".format(line))
-            for row in rows:
-                line = ','.join(str(row[ndx]) for ndx in range(0, len(row)))
-                csvfile.write("{}\n".format(line))
+        with open(filename, "w", newline='', buffering=CSV_BUFFER) as csvfile:
+            writer = csv.writer(csvfile, lineterminator='\n')
+            writer.writerow(columns)
+            writer.writerow(first)
+            writer.writerows(rows)
 
     except DatabaseError:
         sys.stderr.write("An unrecoverable database error occurred, exiting.\n")
@@ -73,10 +73,11 @@ def get_header():
     return ascheader
 
 
-# Read the ASC file and return the header / data
+# Read the ASC file and return the header / data, the data is returned as a
+# float64 NumPy array with the shape (nrows, ncols)
 def load_asc(filename):
     with open(filename) as ascfile:
-        lines = ascfile.readlines()
+        lines = [next(ascfile) for _ in range(6)]
 
         # Read the header values
         ascheader = {}
@@ -88,16 +89,15 @@ def load_asc(filename):
         ascheader['nodata'] = int(lines[5].split()[1])
 
         # Read the rest of the entries
-        ascdata = []
-        for ndx in range(6, ascheader['nrows'] + 6):
-            row = [float(value) for value in lines[ndx].split()]
-            ascdata.append(row)
+        ascdata = np.loadtxt(ascfile, dtype=np.float64, max_rows=ascheader['nrows'])
+        ascdata = ascdata.reshape(ascheader['nrows'], ascheader['ncols'])
 
         return [ascheader, ascdata]
 
 
-# Write an ASC file using the data provided
-def write_asc(ascheader, ascdata, filename):
+# Write an ASC file using the data provided, the values are written using the
+# printf-style format given
+def write_asc(ascheader, ascdata, filename, fmt='%.8g'):
     with open(filename, 'w') as ascfile:
 
         # Write the header values
@@ -109,8 +109,10 @@ def write_asc(ascheader, ascdata, filename):
         ascfile.write('NODATA_value  ' + str(ascheader['nodata']) + '\n')
 
         # Write the data
-        for ndx in range(0, ascheader['nrows']):
-            row = ['{0:.8g}'.format(value) for value in ascdata[ndx]]
-            row = ' '.join(row)
-            ascfile.write(row)
-            ascfile.write('\n')
+        np.savetxt(ascfile, ascdata, fmt=fmt, delimiter=' ')
+
+
+# Write the ASC data as a float32 NumPy binary (.npy) file, note that the header
+# is not included so the ASC file is still needed for the georeferencing
+def write_asc_binary(ascdata, filename):
+    np.save(filename, np.asarray(ascdata, dtype=np.float32))
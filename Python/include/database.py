@@ -1,8 +1,10 @@
 # database.py
 #
 # This module provides a wrapper for basic database functionality.
+import atexit
 import sys
 import psycopg2
+import psycopg2.pool
 
 
 # Custom error for us to throw
@@ -10,23 +12,101 @@ class DatabaseError(BaseException):
     pass
 
 
-def select(connectionString, sql, parameters, columnNames=False):
-    '''Run a select operation on the database indicated by the connection string, with the given parameters.'''
+# Number of rows to fetch from the server at a time when streaming results
+STREAM_ROWS = 10000
 
+# Limits on the number of connections held by each pool
+POOL_MIN = 1
+POOL_MAX = 8
+
+# Connection pools, keyed by the connection string
+_pools = {}
+
+
+def _get_connection(connectionString):
+    '''
+    Get a connection from the pool for the connection string, creating the pool if need be.
+
+    If all of the connections are in use, such as by streams that have not been consumed, then DatabaseError is raised.
+    '''
+
+    if connectionString not in _pools:
+        # Override any timeout provided with something shorter since we expect to 
+        # be running interactively
+        _pools[connectionString] = psycopg2.pool.ThreadedConnectionPool(
+            POOL_MIN, POOL_MAX, connectionString, connect_timeout=1)
+
+    # The pool error is not a database error, so it would otherwise be missed by the callers
     try:
-        # Open the connection, override any timeout provided with something shorter
-        # since we expect to be running interactively
-        connection = psycopg2.connect(connectionString, connect_timeout=1)
-        cursor = connection.cursor()
-
-        # Execute the query, note the rows and column names
-        cursor.execute(sql, parameters)
-        rows = cursor.fetchall()
-        columns = [col[0] for col in cursor.description]
-
-        # Clean-up and return
-        cursor.close()
+        return _pools[connectionString].getconn()
+    except psycopg2.pool.PoolError as err:
+        sys.stderr.write(f'No database connections are available: {err}')
+        raise DatabaseError
+
+
+def _release(connectionString, connection):
+    '''Return the connection to its pool, closing it instead if it is no longer usable.'''
+
+    # The pools may already be closed if we are exiting
+    pool = _pools.get(connectionString)
+    if pool is None or pool.closed:
         connection.close()
+        return
+
+    # End any open transaction so the connection is clean for the next query
+    close = bool(connection.closed)
+    if not close:
+        try:
+            connection.rollback()
+        except psycopg2.Error:
+            close = True
+    pool.putconn(connection, close=close)
+
+
+@atexit.register
+def _close_pools():
+    '''Close all of the connections held by the pools.'''
+
+    for pool in _pools.values():
+        pool.closeall()
+    _pools.clear()
+
+
+def select(connectionString, sql, parameters, columnNames=False, stream=False):
+    '''
+    Run a select operation on the database indicated by the connection string, with the given parameters.
+    
+    If stream is set then the rows are returned as an iterator backed by a server-side cursor, the connection
+    is returned to the pool once the rows have been consumed.
+    '''
+
+    try:
+        connection = _get_connection(connectionString)
+
+        if stream:
+            try:
+                # Execute the query and fetch the first batch so the column names are available
+                cursor = connection.cursor(name='stream')
+                cursor.itersize = STREAM_ROWS
+                cursor.execute(sql, parameters)
+                rows = cursor.fetchmany(STREAM_ROWS)
+                columns = [col[0] for col in cursor.description]
+                rows = _stream(connectionString, connection, cursor, rows)
+            except BaseException:
+                _release(connectionString, connection)
+                raise
+        else:
+            try:
+                # Execute the query, note the rows and column names
+                cursor = connection.cursor()
+                cursor.execute(sql, parameters)
+                rows = cursor.fetchall()
+                columns = [col[0] for col in cursor.description]
+                cursor.close()
+            finally:
+                _release(connectionString, connection)
+
+        # Return the results
         if columnNames:
             return rows, columns
         return rows
@@ -40,23 +120,44 @@ def select(connectionString, sql, parameters, columnNames=False):
         raise DatabaseError
 
 
-def insert_returning(connectionString, sql, parameters):
-    '''Run an insert operation on the database that returns a value.'''
+def _stream(connectionString, connection, cursor, rows):
+    '''Yield the rows that have been fetched followed by the rest of the server-side cursor, then clean-up.'''
 
     try:
-        # Open the connection, override any timeout provided with something shorter
-        # since we expect to be running interactively
-        connection = psycopg2.connect(connectionString, connect_timeout=1)
-        cursor = connection.cursor()
+        yield from rows
+        yield from cursor
+
+    except psycopg2.DatabaseError as err:
+        sys.stderr.write(f'A general database error occurred: {err}')
+        raise DatabaseError
 
-        # Execute the query, note the rows
-        cursor.execute(sql, parameters)
-        returnValue = cursor.fetchone()[0]
+    finally:
+        # Closing the cursor fails if the transaction was aborted, the release will
+        # still clean-up the connection
+        try:
+            cursor.close()
+        except psycopg2.Error:
+            pass
+        _release(connectionString, connection)
 
-        # Clean-up and return
-        connection.commit()
-        cursor.close()
-        return returnValue
+
+def insert_returning(connectionString, sql, parameters):
+    '''Run an insert operation on the database that returns a value.'''
+
+    try:
+        connection = _get_connection(connectionString)
+        try:
+            # Execute the query, note the rows
+            cursor = connection.cursor()
+            cursor.execute(sql, parameters)
+            returnValue = cursor.fetchone()[0]
+
+            # Clean-up and return
+            connection.commit()
+            cursor.close()
+            return returnValue
+        finally:
+            _release(connectionString, connection)
 
     except psycopg2.OperationalError as err:
         sys.stderr.write(f'An error occurred connecting to the database: {err}')
@@ -71,19 +172,19 @@ def update(connectionString, sql, parameters):
     '''Perform an update operation on the database, return the number of rows effected.'''
 
     try:
-        # Open the connection, override any timeout provided with something shorter
-        # since we expect to be running interactively
-        connection = psycopg2.connect(connectionString, connect_timeout=1)
-        cursor = connection.cursor()
-
-        # Execute the query, note the rows affected
-        cursor.execute(sql, parameters)
-        connection.commit()
-        result = cursor.rowcount
-
-        # Clean-up and return
-        cursor.close()
-        return result
+        connection = _get_connection(connectionString)
+        try:
+            # Execute the query, note the rows affected
+            cursor = connection.cursor()
+            cursor.execute(sql, parameters)
+            connection.commit()
+            result = cursor.rowcount
+
+            # Clean-up and return
+            cursor.close()
+            return result
+        finally:
+            _release(connectionString, connection)
 
     except psycopg2.OperationalError as err:
         sys.stderr.write(f'An error occurred connecting to the database: {err}')
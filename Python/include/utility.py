@@ -2,11 +2,26 @@
 #
 # Various utility functions for Python
 import sys
+import time
 
-# Progress bar for console applications
+# Minimum time, in seconds, between progress bar updates
+PROGRESS_INTERVAL = 0.2
+
+# Time of the last progress bar update
+_lastUpdate = 0
+
+# Progress bar for console applications, updates are throttled to one per 
+# PROGRESS_INTERVAL although the final update is always shown
 #
 # Adopted from https://stackoverflow.com/a/37630397/1185
 def progressBar(current, total, barLength = 20):
+    global _lastUpdate
+
+    now = time.monotonic()
+    if current < total and now - _lastUpdate < PROGRESS_INTERVAL:
+        return
+    _lastUpdate = now
+
     percent = float(current) / total
     arrow = '-' * int(round(percent * barLength)-1) + '>'
     spaces = ' ' * (barLength - len(arrow))